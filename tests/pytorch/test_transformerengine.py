@@ -2,6 +2,10 @@
 #
 # See LICENSE for license information.
 
+import copy
+import math
+import pickle
+
 import torch
 import pytest
 
@@ -14,6 +18,13 @@ from transformer_engine.pytorch import (
     Linear,
     LayerNormMLP,
     TransformerLayer,
+    DotProductAttention,
+)
+import transformer_engine.pytorch.transformer as te_transformer
+from transformer_engine.pytorch.transformer import (
+    MultiHeadAttention,
+    UnfusedDotProductAttention,
+    _SBHDOutputBMM,
 )
 
 
@@ -35,11 +46,34 @@ model_configs = {
 
 param_types = [torch.float32, torch.bfloat16, torch.float16]
 
+# Tolerances for comparing two implementations of the same computation.
+dtype_tols = {
+    torch.float32: dict(rtol=1e-4, atol=1e-4),
+    torch.float16: dict(rtol=5e-3, atol=5e-3),
+    torch.bfloat16: dict(rtol=2e-2, atol=2e-2),
+}
+
 batch_sizes = [1, 2]
 
 all_boolean = [True, False]
 
 
+class InferenceParams:
+    def __init__(self, max_batch_size, max_sequence_len):
+        self.max_sequence_len = max_sequence_len
+        self.max_batch_size = max_batch_size
+        self.sequence_len_offset = 0
+        self.batch_size_offset = 0
+        self.key_value_memory_dict = {}
+
+
+def _assert_variants_close(outputs, dtype):
+    """Compare the tensors, e.g. output and gradients, collected for each of two
+    variants of the same computation"""
+    for tensor, ref_tensor in zip(*outputs):
+        assert not tensor.isnan().any()
+        torch.testing.assert_close(tensor, ref_tensor, **dtype_tols[dtype])
+
 
 def _disable_wgrads(block):
     for p in block.parameters():
@@ -133,6 +167,16 @@ def _test_sanity_e2e_T5(block, bs, dtype, config, skip_wgrad):
     torch.cuda.synchronize()
 
 
+def _test_inference(block, inp, prefill_len, inference_params):
+    """Run the prompt `inp[:prefill_len]` and then decode the rest one token at a time"""
+    outputs = []
+    steps = [inp[:prefill_len]] + list(inp[prefill_len:].split(1))
+    for step in steps:
+        outputs.append(block(step, inference_params=inference_params))
+        inference_params.sequence_len_offset += step.size(0)
+    return torch.cat(outputs)
+
+
 def _test_sanity_common(block, bs, dtype, config, skip_wgrad):
     te_inp = torch.randn(
         config.seq_len, bs, config.hidden_size, dtype=dtype, requires_grad=True
@@ -388,6 +432,53 @@ def test_sanity_drop_path(dtype, bs, model, skip_wgrad):
     _test_sanity_e2e(block, bs, dtype, config, skip_wgrad)
 
 
+@pytest.mark.parametrize("dtype", param_types)
+@pytest.mark.parametrize("bs", batch_sizes)
+@pytest.mark.parametrize("model", model_configs.keys())
+def test_sanity_drop_path_fusion(dtype, bs, model, monkeypatch):
+    config = model_configs[model]
+
+    sigma = 0.023
+    init_method = init_method_normal(sigma)
+    output_layer_init_method = scaled_init_method_normal(sigma, config.num_layers)
+
+    blocks = []
+    for bias_dropout_fusion in (True, False):
+        monkeypatch.setattr(te_transformer, "_NVTE_BIAS_DROPOUT_FUSION", bias_dropout_fusion)
+        # The fused and unfused dropouts draw different random numbers, so
+        # only the drop path, which draws its noise outside the fusion, is on.
+        blocks.append(
+            TransformerLayer(
+                config.hidden_size,
+                4 * config.hidden_size,
+                config.num_attention_heads,
+                layernorm_epsilon=config.eps,
+                init_method=init_method,
+                output_layer_init_method=output_layer_init_method,
+                hidden_dropout=0.0,
+                attention_dropout=0.0,
+                kv_channels=config.embed,
+                drop_path_rate=0.5,
+            )
+            .to(dtype=dtype)
+            .cuda()
+        )
+    blocks[1].load_state_dict(blocks[0].state_dict())
+
+    te_inp = torch.randn(config.seq_len, bs, config.hidden_size, dtype=dtype, device="cuda")
+    out_grad = torch.randn_like(te_inp)
+
+    outputs = []
+    for block in blocks:
+        inp = te_inp.clone().requires_grad_()
+        torch.manual_seed(1234)
+        out = block(inp)
+        out.backward(out_grad)
+        outputs.append((out, inp.grad))
+
+    _assert_variants_close(outputs, dtype)
+
+
 @pytest.mark.parametrize("dtype", param_types)
 @pytest.mark.parametrize("bs", batch_sizes)
 @pytest.mark.parametrize("model", model_configs.keys())
@@ -419,3 +510,262 @@ def test_sanity_fused_qkv_params(dtype, bs, model, skip_wgrad):
     )
 
     _test_sanity_e2e(block, bs, dtype, config, skip_wgrad)
+
+
+@pytest.mark.parametrize("dtype", [torch.float32, torch.float16])
+@pytest.mark.parametrize("attn_mask_type", ["causal", "padding"])
+@pytest.mark.parametrize("fully_masked_rows", all_boolean)
+def test_sdpa_matches_unfused_attention(dtype, attn_mask_type, fully_masked_rows):
+    bs, num_heads, seq_len, head_dim = 2, 16, 128, 64
+
+    core_attention = UnfusedDotProductAttention(
+        math.sqrt(head_dim), attn_mask_type=attn_mask_type
+    ).cuda()
+    if not core_attention.use_sdpa:
+        pytest.skip("torch SDPA is not available")
+
+    # Pad the keys of the second sequence.
+    lengths = torch.tensor([seq_len, seq_len // 2], device="cuda")
+    attention_mask = torch.arange(seq_len, device="cuda") >= lengths.view(bs, 1, 1, 1)
+    attention_mask = attention_mask.repeat(1, 1, seq_len, 1)
+    if fully_masked_rows:
+        attention_mask[1, :, : seq_len // 4] = True
+
+    inps = [
+        torch.randn(
+            seq_len, bs, num_heads, head_dim, dtype=dtype, device="cuda", requires_grad=True
+        )
+        for _ in range(3)
+    ]
+    out_grad = torch.randn(seq_len, bs, num_heads * head_dim, dtype=dtype, device="cuda")
+
+    outputs = []
+    for use_sdpa in (True, False):
+        core_attention.use_sdpa = use_sdpa
+        out = core_attention(*inps, attention_mask)
+        out.backward(out_grad)
+        outputs.append([out] + [inp.grad for inp in inps])
+        for inp in inps:
+            inp.grad = None
+
+    _assert_variants_close(outputs, dtype)
+
+
+@pytest.mark.parametrize("bs", batch_sizes)
+def test_cuda_graph_decode(bs, monkeypatch):
+    hidden_size, num_heads, seq_len, prefill_len = 256, 4, 16, 8
+
+    monkeypatch.setattr(te_transformer, "_NVTE_CUDA_GRAPH_DECODE", True)
+    block = (
+        TransformerLayer(
+            hidden_size,
+            4 * hidden_size,
+            num_heads,
+            hidden_dropout=0.0,
+            attention_dropout=0.0,
+            layer_number=1,
+        )
+        .cuda()
+        .eval()
+    )
+    decode_graphs = block.self_attention._decode_graphs
+    assert decode_graphs is not None
+
+    inp = torch.randn(seq_len, bs, hidden_size, device="cuda")
+
+    with torch.no_grad():
+        graph_out = _test_inference(block, inp, prefill_len, InferenceParams(bs, seq_len))
+
+        # All decode steps replay the graph captured for the first one.
+        assert len(decode_graphs) == 1
+        graph = next(iter(decode_graphs.values()))[0]
+
+        # A new generation releases the graph captured for the previous cache.
+        _test_inference(block, inp, prefill_len, InferenceParams(bs, seq_len))
+        assert len(decode_graphs) == 1
+        assert next(iter(decode_graphs.values()))[0] is not graph
+
+        block.self_attention._decode_graphs = None
+        eager_out = _test_inference(block, inp, prefill_len, InferenceParams(bs, seq_len))
+
+    torch.testing.assert_close(graph_out, eager_out, rtol=1e-4, atol=1e-4)
+
+
+def test_construction_preserves_cuda_rng(monkeypatch):
+    # Parameter initialization draws from the CUDA RNG as well, so compare
+    # against the same layer built without the JIT warmup.
+    rng_states = []
+    for bias_dropout_fusion in (False, True):
+        monkeypatch.setattr(te_transformer, "_NVTE_BIAS_DROPOUT_FUSION", bias_dropout_fusion)
+        torch.manual_seed(1234)
+        # No shapes are given, so only the implicit JIT warmup runs.
+        TransformerLayer(160, 640, 4)
+        rng_states.append(torch.cuda.get_rng_state())
+    assert torch.equal(*rng_states)
+
+
+@pytest.mark.parametrize("bias_dropout_fusion", all_boolean)
+def test_transformer_layer_pickle(bias_dropout_fusion, monkeypatch):
+    monkeypatch.setattr(te_transformer, "_NVTE_BIAS_DROPOUT_FUSION", bias_dropout_fusion)
+    block = TransformerLayer(256, 1024, 4).cuda()
+    pickle.loads(pickle.dumps(block))
+
+
+def test_transformer_layer_deepcopy_with_torch_compile(monkeypatch):
+    monkeypatch.setattr(te_transformer, "_NVTE_TORCH_COMPILE", True)
+    monkeypatch.setattr(te_transformer, "_NVTE_COMPILE_UNFUSED_ATTN", True)
+    block = TransformerLayer(256, 1024, 4).cuda().eval()
+    block_copy = copy.deepcopy(block)
+    pickle.loads(pickle.dumps(block_copy))
+
+    # With all of its parameters zeroed, the copy passes its input through.
+    with torch.no_grad():
+        for param in block_copy.parameters():
+            param.zero_()
+        inp = torch.randn(16, 2, 256, device="cuda")
+        torch.testing.assert_close(block_copy(inp), inp)
+        assert not torch.allclose(block(inp), inp)
+
+
+@pytest.mark.parametrize("dtype", param_types)
+def test_sbhd_output_bmm(dtype):
+    attn_batches, sq, sk, head_dim = 8, 32, 48, 64
+    probs = torch.rand(attn_batches, sq, sk, dtype=dtype, device="cuda", requires_grad=True)
+    value = torch.randn(attn_batches, sk, head_dim, dtype=dtype, device="cuda", requires_grad=True)
+    out_grad = torch.randn(sq, attn_batches, head_dim, dtype=dtype, device="cuda")
+
+    outputs = []
+    for bmm in (
+        _SBHDOutputBMM.apply,
+        lambda probs, value: torch.bmm(probs, value).permute(1, 0, 2).contiguous(),
+    ):
+        out = bmm(probs, value)
+        out.backward(out_grad)
+        outputs.append((out, probs.grad, value.grad))
+        probs.grad = value.grad = None
+
+    assert outputs[0][0].is_contiguous()
+    _assert_variants_close(outputs, dtype)
+
+
+def test_sbhd_output_bmm_gradcheck():
+    probs = torch.rand(4, 6, 5, dtype=torch.float64, device="cuda", requires_grad=True)
+    value = torch.randn(4, 5, 3, dtype=torch.float64, device="cuda", requires_grad=True)
+    assert torch.autograd.gradcheck(_SBHDOutputBMM.apply, (probs, value))
+
+
+@pytest.mark.parametrize("dtype", param_types)
+@pytest.mark.parametrize("use_flash_attention", all_boolean)
+def test_dot_product_attention_bshd(dtype, use_flash_attention):
+    if dtype == torch.bfloat16 and not torch.cuda.is_bf16_supported():
+        pytest.skip("bf16 is not supported")
+    bs, num_heads, seq_len, head_dim = 2, 16, 128, 64
+
+    block = DotProductAttention(num_heads, head_dim).cuda()
+    # flash-attn is only used for fp16 and bf16 inputs.
+    block.use_flash_attention = block.use_flash_attention and use_flash_attention
+
+    te_inps = [
+        torch.randn(seq_len, bs, num_heads, head_dim, dtype=dtype, device="cuda")
+        for _ in range(3)
+    ]
+    out_grad = torch.randn(seq_len, bs, num_heads * head_dim, dtype=dtype, device="cuda")
+
+    outputs = []
+    for qkv_format in ("bshd", "sbhd"):
+        # [s, b, np, hn] --> [b, s, np, hn]
+        transpose = qkv_format == "bshd"
+        inps = [
+            (inp.transpose(0, 1).contiguous() if transpose else inp.clone()).requires_grad_()
+            for inp in te_inps
+        ]
+        out = block(*inps, qkv_format=qkv_format)
+        out.backward(out_grad)
+        outputs.append(
+            [out] + [inp.grad.transpose(0, 1) if transpose else inp.grad for inp in inps]
+        )
+
+    _assert_variants_close(outputs, dtype)
+
+
+@pytest.mark.parametrize("dtype", [torch.float16, torch.bfloat16])
+@pytest.mark.parametrize("input_layernorm", all_boolean)
+def test_multihead_attention_flash_attn_input(dtype, input_layernorm):
+    if dtype == torch.bfloat16 and not torch.cuda.is_bf16_supported():
+        pytest.skip("bf16 is not supported")
+    bs, num_heads, seq_len, head_dim = 2, 16, 128, 64
+    hidden_size = num_heads * head_dim
+
+    sigma = 0.023
+    block = (
+        MultiHeadAttention(
+            hidden_size,
+            num_heads,
+            head_dim,
+            0.0,
+            1e-5,
+            init_method_normal(sigma),
+            scaled_init_method_normal(sigma, 1),
+            input_layernorm=input_layernorm,
+            attention_type="self",
+        )
+        .to(dtype=dtype)
+        .cuda()
+    )
+    if not block.core_attention.use_flash_attention:
+        pytest.skip("flash-attn is disabled")
+
+    te_inp = torch.randn(seq_len, bs, hidden_size, dtype=dtype, device="cuda")
+    out_grad = torch.randn_like(te_inp)
+
+    # With flash-attn, the projection input is transposed to [b, s, h].
+    # Without, the projection output stays in the [s, b, h] layout.
+    outputs = []
+    for use_flash_attention in (True, False):
+        block.core_attention.use_flash_attention = use_flash_attention
+        inp = te_inp.clone().requires_grad_()
+        out, _ = block(inp)
+        out.backward(out_grad)
+        outputs.append((out, inp.grad))
+
+    _assert_variants_close(outputs, dtype)
+
+
+@pytest.mark.parametrize("bs", batch_sizes)
+def test_inference_kv_cache(bs):
+    hidden_size, num_heads, seq_len, prefill_len = 256, 4, 16, 8
+    head_dim = hidden_size // num_heads
+
+    block = (
+        TransformerLayer(
+            hidden_size,
+            4 * hidden_size,
+            num_heads,
+            hidden_dropout=0.0,
+            attention_dropout=0.0,
+            layer_number=1,
+        )
+        .cuda()
+        .eval()
+    )
+    cache_key = block.self_attention.layer_number
+    inp = torch.randn(seq_len, bs, hidden_size, device="cuda")
+
+    # Keys and values cached in the two halves of one buffer, updated with a
+    # single copy, and in separate buffers, updated with a copy each.
+    packed_params = InferenceParams(bs, seq_len)
+    separate_params = InferenceParams(bs, seq_len)
+    separate_params.key_value_memory_dict[cache_key] = tuple(
+        torch.zeros(seq_len, bs, num_heads, head_dim, device="cuda") for _ in range(2)
+    )
+
+    with torch.no_grad():
+        packed_out = _test_inference(block, inp, prefill_len, packed_params)
+        separate_out = _test_inference(block, inp, prefill_len, separate_params)
+
+    packed_cache = packed_params.key_value_memory_dict[cache_key]
+    separate_cache = separate_params.key_value_memory_dict[cache_key]
+    assert packed_cache[0]._base is not None
+    assert packed_cache[0]._base is packed_cache[1]._base
+    torch.testing.assert_close(packed_cache, separate_cache, rtol=0, atol=0)
+    torch.testing.assert_close(packed_out, separate_out)
@@ -25,6 +25,8 @@ AttnMaskTypes = ("causal", "padding")
 
 AttnTypes = ("self", "cross")
 
+QKVFormats = ("sbhd", "bshd")
+
 LayerTypes = ("encoder", "decoder")
 
 GemmParallelModes = ("row", "column", None)
@@ -7,12 +7,25 @@ from typing import Callable, Tuple
 import torch
 
 
+TORCH_MAJOR = int(torch.__version__.split(".")[0])
+TORCH_MINOR = int(torch.__version__.split(".")[1])
+use_nvfuser = TORCH_MAJOR > 1 or (TORCH_MAJOR == 1 and TORCH_MINOR >= 10)
+
+_JIT_FUSION_OPTIONS_SET = False
+_BIAS_DROPOUT_ADD_WARMED_UP = set()
+_BIAS_GELU_WARMED_UP = set()
+
+
 def set_jit_fusion_options() -> None:
-    """Set PyTorch JIT layer fusion options."""
+    """Set PyTorch JIT layer fusion options. The global JIT flags are
+    only set on the first call."""
+    global _JIT_FUSION_OPTIONS_SET
+    if _JIT_FUSION_OPTIONS_SET:
+        return
+    _JIT_FUSION_OPTIONS_SET = True
+
     # flags required to enable jit fusion kernels
-    TORCH_MAJOR = int(torch.__version__.split(".")[0])
-    TORCH_MINOR = int(torch.__version__.split(".")[1])
-    if (TORCH_MAJOR > 1) or (TORCH_MAJOR == 1 and TORCH_MINOR >= 10):
+    if use_nvfuser:
         # nvfuser
         torch._C._jit_set_profiling_executor(True)
         torch._C._jit_set_profiling_mode(True)
@@ -124,8 +137,58 @@ def bias_dropout_add_fused_inference(
         return bias_dropout_add_fused_inference_(x, bias, residual, prob)
 
 
+@torch.jit.script
+def drop_path_fused_(
+    inp: torch.Tensor, noise: torch.Tensor, keep_prob: float
+) -> torch.Tensor:
+    """Jit fused per-sample mask binarization, scaling and drop path"""
+    return inp.div(keep_prob) * torch.floor(noise + keep_prob)
+
+
+def drop_path_fused(
+    inp: torch.Tensor, noise: torch.Tensor, keep_prob: float
+) -> torch.Tensor:
+    """Disable native AMP for `drop_path_fused_`"""
+    with torch.cuda.amp.autocast(enabled=False):
+        return drop_path_fused_(inp, noise, keep_prob)
+
+
+@torch.jit.script
+def bias_dropout_drop_path_add_fused_train_(
+    x: torch.Tensor,
+    bias: torch.Tensor,
+    residual: torch.Tensor,
+    noise: torch.Tensor,
+    prob: float,
+    keep_prob: float,
+) -> torch.Tensor:
+    """Jit fused bias_dropout_add with per-sample drop path for training"""
+    out = torch.nn.functional.dropout(x + bias, p=prob, training=True)
+    return residual + out.div(keep_prob) * torch.floor(noise + keep_prob)
+
+
+def bias_dropout_drop_path_add_fused_train(
+    x: torch.Tensor,
+    bias: torch.Tensor,
+    residual: torch.Tensor,
+    noise: torch.Tensor,
+    prob: float,
+    keep_prob: float,
+) -> torch.Tensor:
+    """Disable native AMP and enable grad for `bias_dropout_drop_path_add_fused_train_`"""
+    with torch.enable_grad():
+        with torch.cuda.amp.autocast(enabled=False):
+            return bias_dropout_drop_path_add_fused_train_(
+                x, bias, residual, noise, prob, keep_prob
+            )
+
+
 def warmup_jit_bias_dropout_add(
-    hidden_size: int, dtype: torch.dtype, seq_length: int, micro_batch_size: int
+    hidden_size: int,
+    dtype: torch.dtype,
+    seq_length: int,
+    micro_batch_size: int,
+    empty_cache: bool = True,
 ) -> None:
     """Compilie BDA JIT function before the main training steps"""
     # Warmup fused bias+dropout+add
@@ -148,15 +211,22 @@ def warmup_jit_bias_dropout_add(
         for _ in range(5):
             output = bias_dropout_add_fused_train(inp, bias, residual, dropout_rate)
     del bias, inp, residual, output
-    torch.cuda.empty_cache()
+    if empty_cache:
+        torch.cuda.empty_cache()
 
 
 def warmup_jit_bias_dropout_add_all_dtypes(
-    hidden_size: int, seq_length: int, micro_batch_size: int
+    hidden_size: int, seq_length: int, micro_batch_size: int, empty_cache: bool = True
 ) -> None:
-    """Call `warmup_jit_bias_dropout_add` for all training dtypes"""
+    """Call `warmup_jit_bias_dropout_add` for all training dtypes, once per shape"""
+    key = (hidden_size, seq_length, micro_batch_size)
+    if key in _BIAS_DROPOUT_ADD_WARMED_UP:
+        return
     for dtype in [torch.float32, torch.bfloat16, torch.float16]:
-        warmup_jit_bias_dropout_add(hidden_size, dtype, seq_length, micro_batch_size)
+        warmup_jit_bias_dropout_add(
+            hidden_size, dtype, seq_length, micro_batch_size, empty_cache=empty_cache
+        )
+    _BIAS_DROPOUT_ADD_WARMED_UP.add(key)
 
 
 def warmup_jit_bias_gelu(
@@ -185,6 +255,10 @@ def warmup_jit_bias_gelu(
 def warmup_jit_bias_gelu_all_dtypes(
     ffn_hidden_size: int, seq_length: int, micro_batch_size: int
 ) -> None:
-    """Call `warmup_jit_bias_gelu` for all training dtypes"""
+    """Call `warmup_jit_bias_gelu` for all training dtypes, once per shape"""
+    key = (ffn_hidden_size, seq_length, micro_batch_size)
+    if key in _BIAS_GELU_WARMED_UP:
+        return
     for dtype in [torch.float32, torch.bfloat16, torch.float16]:
         warmup_jit_bias_gelu(ffn_hidden_size, dtype, seq_length, micro_batch_size)
+    _BIAS_GELU_WARMED_UP.add(key)
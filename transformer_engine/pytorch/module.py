@@ -83,6 +83,11 @@ _2X_ACC_DGRAD = True
 _2X_ACC_WGRAD = True
 _cublas_workspace = None
 
+# LayerNorm SM margins and the bias-GeLU fusion switch, fixed for the process.
+_NVTE_FWD_LAYERNORM_SM_MARGIN = int(os.getenv("NVTE_FWD_LAYERNORM_SM_MARGIN", "0"))
+_NVTE_BWD_LAYERNORM_SM_MARGIN = int(os.getenv("NVTE_BWD_LAYERNORM_SM_MARGIN", "0"))
+_NVTE_BIAS_GELU_NVFUSION = bool(int(os.getenv("NVTE_BIAS_GELU_NVFUSION", "1")))
+
 
 def get_cublas_workspace_size_bytes() -> None:
     """Return 32 MiB if using hopper, 4 MiB for all other architectures."""
@@ -1252,8 +1257,8 @@ class LayerNormLinear(TransformerEngineBaseModule):
         # and backward LayerNorm C APIs. These envvars can be used to prevent the LN
         # kernels from using all SMs in the device. This is useful for cases such as
         # communication overlap with LN.
-        self.fwd_ln_sm_margin = int(os.getenv("NVTE_FWD_LAYERNORM_SM_MARGIN", "0"))
-        self.bwd_ln_sm_margin = int(os.getenv("NVTE_BWD_LAYERNORM_SM_MARGIN", "0"))
+        self.fwd_ln_sm_margin = _NVTE_FWD_LAYERNORM_SM_MARGIN
+        self.bwd_ln_sm_margin = _NVTE_BWD_LAYERNORM_SM_MARGIN
 
     def reset_layer_norm_parameters(self) -> None:
         """Init LN params"""
@@ -2658,7 +2663,7 @@ class LayerNormMLP(TransformerEngineBaseModule):
         self.use_bias = bias
         self.return_bias = return_bias
         self.return_layernorm_output = return_layernorm_output
-        self.bias_gelu_nvfusion = bool(int(os.getenv("NVTE_BIAS_GELU_NVFUSION", "1")))
+        self.bias_gelu_nvfusion = _NVTE_BIAS_GELU_NVFUSION
         self.set_parallel_mode = set_parallel_mode
         self.zero_centered_gamma = zero_centered_gamma
 
@@ -2780,8 +2785,8 @@ class LayerNormMLP(TransformerEngineBaseModule):
         # and backward LayerNorm C APIs. These envvars can be used to prevent the LN
         # kernels from using all SMs in the device. This is useful for cases such as
         # communication overlap with LN.
-        self.fwd_ln_sm_margin = int(os.getenv("NVTE_FWD_LAYERNORM_SM_MARGIN", "0"))
-        self.bwd_ln_sm_margin = int(os.getenv("NVTE_BWD_LAYERNORM_SM_MARGIN", "0"))
+        self.fwd_ln_sm_margin = _NVTE_FWD_LAYERNORM_SM_MARGIN
+        self.bwd_ln_sm_margin = _NVTE_BWD_LAYERNORM_SM_MARGIN
 
     def reset_layer_norm_parameters(self) -> None:
         """Init LN params"""
@@ -2979,8 +2984,8 @@ class LayerNorm(torch.nn.Module):
         # and backward LayerNorm C APIs. These envvars can be used to prevent the LN
         # kernels from using all SMs in the device. This is useful for cases such as
         # communication overlap with LN.
-        self.fwd_ln_sm_margin = int(os.getenv("NVTE_FWD_LAYERNORM_SM_MARGIN", "0"))
-        self.bwd_ln_sm_margin = int(os.getenv("NVTE_BWD_LAYERNORM_SM_MARGIN", "0"))
+        self.fwd_ln_sm_margin = _NVTE_FWD_LAYERNORM_SM_MARGIN
+        self.bwd_ln_sm_margin = _NVTE_BWD_LAYERNORM_SM_MARGIN
 
     def load_state_dict(
         self,
@@ -4,7 +4,7 @@
 
 """Fused scaled masked softmax functions"""
 import os
-from typing import Callable, Tuple, Union
+from typing import Callable, Optional, Tuple, Union
 import torch
 from torch import nn
 import torch._C._onnx as _C_onnx
@@ -15,6 +15,8 @@ import transformer_engine_extensions as tex
 THREADS_PER_WARP = 32
 THREADS_PER_BLOCK = 128
 
+_NVTE_MASKED_SOFTMAX_FUSION = bool(int(os.getenv("NVTE_MASKED_SOFTMAX_FUSION", "1")))
+
 
 class ScaledUpperTriangMaskedSoftmax(torch.autograd.Function):
     """
@@ -201,9 +203,7 @@ class FusedScaleMaskSoftmax(nn.Module):
     ) -> None:
         super().__init__()
         self.attn_mask_type = attn_mask_type
-        self.scaled_masked_softmax_fusion = bool(
-            int(os.getenv("NVTE_MASKED_SOFTMAX_FUSION", "1"))
-        )
+        self.scaled_masked_softmax_fusion = _NVTE_MASKED_SOFTMAX_FUSION
         self.mask_func = mask_func
         self.softmax_in_fp32 = softmax_in_fp32
         self.scale = scale
@@ -224,13 +224,21 @@ class FusedScaleMaskSoftmax(nn.Module):
             return self.forward_fused_softmax(inp, mask)
         return self.forward_torch_softmax(inp, mask)
 
-    def is_kernel_available(self, b: int, np: int, sq: int, sk: int) -> bool:
-        """Check FusedScaleMaskSoftmax kernel availability based on size"""
+    def is_kernel_available(
+        self, b: int, np: int, sq: int, sk: int, dtype: Optional[torch.dtype] = None
+    ) -> bool:
+        """Check FusedScaleMaskSoftmax kernel availability based on size, and on
+        `dtype` when given instead of the dtype of the current input"""
         attn_batches = b * np
+        input_in_float16 = (
+            self.input_in_float16
+            if dtype is None
+            else dtype in (torch.float16, torch.bfloat16)
+        )
 
         if (
             self.scaled_masked_softmax_fusion  # user want to fuse
-            and self.input_in_float16  # input must be fp16
+            and input_in_float16  # input must be fp16
             and 16 < sk <= 4096  # sk must be 16 ~ 2048
             and sq % 4 == 0  # sq must be divisor of 4
             and attn_batches % 4 == 0  # np * b must be divisor of 4
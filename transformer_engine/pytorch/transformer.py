@@ -4,33 +4,39 @@
 
 """Transformer."""
 import os
-import re
 import math
+from collections import OrderedDict
 from contextlib import nullcontext
-from typing import Any, Callable, Optional, Tuple, Union
+from functools import partial
+from importlib.metadata import version as _pkg_version, PackageNotFoundError
+from typing import Any, Callable, Dict, Optional, Tuple, Union
 
+from packaging.version import Version as PkgVersion, InvalidVersion
 import torch
 
 from flash_attn.flash_attn_interface import flash_attn_unpadded_func
 
 from transformer_engine.pytorch import LayerNormLinear, Linear, LayerNormMLP, LayerNorm
 from transformer_engine.pytorch.jit import (
+    use_nvfuser,
     set_jit_fusion_options,
     warmup_jit_bias_dropout_add_all_dtypes,
-    get_bias_dropout_add,
+    bias_dropout_add,
     bias_dropout_add_fused_train,
     bias_dropout_add_fused_inference,
+    bias_dropout_drop_path_add_fused_train,
+    drop_path_fused,
 )
 from transformer_engine.pytorch.utils import (
     divide,
     attention_mask_func,
-    split_tensor_along_last_dim,
     cast_if_needed,
     get_default_init_method,
 )
 from transformer_engine.pytorch.constants import (
     AttnMaskTypes,
     AttnTypes,
+    QKVFormats,
     LayerTypes,
     dist_group_type,
 )
@@ -40,12 +46,48 @@ from transformer_engine.pytorch.distributed import (
     checkpoint,
 )
 
-_flash_attn_version = re.search("Version: (.*)", os.popen("pip show flash_attn").read()).group(1)
+try:
+    _flash_attn_version = PkgVersion(_pkg_version("flash_attn"))
+except (PackageNotFoundError, InvalidVersion):
+    _flash_attn_version = None
+# Only development builds of the hopper fork of flash-attn are supported.
+_flash_attn_version_supported = (
+    _flash_attn_version is not None and _flash_attn_version.is_devrelease
+)
+
+
+# Attention backend and fusion switches. Changing the variables after
+# import has no effect.
+_NVTE_FLASH_ATTN = bool(int(os.getenv("NVTE_FLASH_ATTN", "1")))
+_NVTE_USE_SDPA = bool(int(os.getenv("NVTE_USE_SDPA", "1")))
+_NVTE_COMPILE_UNFUSED_ATTN = bool(int(os.getenv("NVTE_COMPILE_UNFUSED_ATTN", "0")))
+_NVTE_CUDA_GRAPH_DECODE = bool(int(os.getenv("NVTE_CUDA_GRAPH_DECODE", "0")))
+_NVTE_BIAS_DROPOUT_FUSION = bool(int(os.getenv("NVTE_BIAS_DROPOUT_FUSION", "1")))
+_NVTE_TORCH_COMPILE = bool(int(os.getenv("NVTE_TORCH_COMPILE", "0")))
+
+_CU_SEQLENS_CACHE_SIZE = 8
+_FLASH_ATTN_DTYPES = frozenset((torch.bfloat16, torch.float16))
+_DECODE_GRAPH_CACHE_SIZE = 4
 
 
 __all__ = ["DotProductAttention", "TransformerLayer"]
 
 
+_COMPILED_FUNCTIONS = {}
+
+
+def _compiled(func: Callable) -> Callable:
+    """`torch.compile` with dynamic shapes of an unbound module method, created on
+    first use and shared by all instances, which pass themselves explicitly. This
+    keeps compiled closures over a module out of its attributes, where they would
+    survive `copy.deepcopy` and break pickling."""
+    compiled_func = _COMPILED_FUNCTIONS.get(func)
+    if compiled_func is None:
+        compiled_func = torch.compile(func, dynamic=True)
+        _COMPILED_FUNCTIONS[func] = compiled_func
+    return compiled_func
+
+
 class DropPath(torch.nn.Module):
     """Drop paths (Stochastic Depth) per sample
     (when applied in main path of residual blocks).
@@ -63,13 +105,70 @@ class DropPath(torch.nn.Module):
         keep_prob = 1 - self.drop_prob
         # work with diff dim tensors, not just 2D ConvNets
         shape = (hidden_state.shape[0],) + (1,) * (hidden_state.ndim - 1)
-        random_tensor = keep_prob + torch.rand(
-            shape, dtype=hidden_state.dtype, device=hidden_state.device
+        noise = torch.rand(shape, dtype=hidden_state.dtype, device=hidden_state.device)
+        # binarize, scale and apply in a single fused kernel
+        return drop_path_fused(hidden_state, noise, keep_prob)
+
+    def bias_dropout_add(
+        self,
+        x: torch.Tensor,
+        bias: torch.Tensor,
+        residual: torch.Tensor,
+        prob: float,
+        fused: bool,
+    ) -> torch.Tensor:
+        """residual + drop_path(dropout(x + bias)), fused into a single kernel
+        when training if `fused` is set"""
+        if not fused or self.drop_prob == 0.0 or not self.training:
+            out = torch.nn.functional.dropout(x + bias, p=prob, training=self.training)
+            return residual + self(out)
+        keep_prob = 1 - self.drop_prob
+        shape = (x.shape[0],) + (1,) * (x.ndim - 1)
+        noise = torch.rand(shape, dtype=x.dtype, device=x.device)
+        return bias_dropout_drop_path_add_fused_train(x, bias, residual, noise, prob, keep_prob)
+
+
+class _SBHDOutputBMM(torch.autograd.Function):
+    """
+    BMM2 of the attention, [b * np, sq, sk] x [b * np, sk, hn], writing its
+    output directly in the [sq, b * np, hn] layout expected downstream so
+    that no permute copy of the context is needed.
+    """
+
+    @staticmethod
+    def forward(
+        ctx, attention_probs: torch.Tensor, value_layer: torch.Tensor
+    ) -> torch.Tensor:
+        """_SBHDOutputBMM fwd"""
+        output = torch.empty(
+            attention_probs.size(1),
+            attention_probs.size(0),
+            value_layer.size(2),
+            dtype=attention_probs.dtype,
+            device=attention_probs.device,
         )
-        random_tensor.floor_()  # binarize
-        output = hidden_state.div(keep_prob) * random_tensor
+        # The transposed output is a valid strided batch for cuBLAS.
+        torch.bmm(attention_probs, value_layer, out=output.transpose(0, 1))
+
+        ctx.save_for_backward(attention_probs, value_layer)
         return output
 
+    @staticmethod
+    def backward(
+        ctx, output_grads: torch.Tensor
+    ) -> Tuple[Union[torch.Tensor, None], ...]:
+        """_SBHDOutputBMM bwd"""
+        attention_probs, value_layer = ctx.saved_tensors
+        # [sq, b * np, hn] --> [b * np, sq, hn]
+        output_grads = output_grads.transpose(0, 1)
+
+        probs_grads = value_grads = None
+        if ctx.needs_input_grad[0]:
+            probs_grads = torch.bmm(output_grads, value_layer.transpose(1, 2))
+        if ctx.needs_input_grad[1]:
+            value_grads = torch.bmm(attention_probs.transpose(1, 2), output_grads)
+        return probs_grads, value_grads
+
 
 class UnfusedDotProductAttention(torch.nn.Module):
     """Parallel attention w/o QKV and Proj Gemms
@@ -94,6 +193,15 @@ class UnfusedDotProductAttention(torch.nn.Module):
 
         self.norm_factor = norm_factor
         self.attention_dropout_ctx = attention_dropout_ctx
+        self.attn_mask_type = attn_mask_type
+
+        # PyTorch's fused SDPA kernels always compute softmax in fp32.
+        self.use_sdpa = (
+            _NVTE_USE_SDPA
+            and hasattr(torch.nn.functional, "scaled_dot_product_attention")
+            and attention_softmax_in_fp32
+        )
+        self._sdpa_mask_cache = None
 
         self.scale_mask_softmax = FusedScaleMaskSoftmax(
             attn_mask_type,
@@ -107,45 +215,83 @@ class UnfusedDotProductAttention(torch.nn.Module):
         # on average it should not be partition dependent.
         self.attention_dropout = torch.nn.Dropout(attention_dropout)
 
+        # Let TorchInductor fuse the elementwise ops around the BMMs and softmax.
+        self.use_torch_compile = _NVTE_COMPILE_UNFUSED_ATTN and hasattr(torch, "compile")
+
     def forward(
         self,
         query_layer: torch.Tensor,
         key_layer: torch.Tensor,
         value_layer: torch.Tensor,
         attention_mask: Optional[torch.Tensor] = None,
+        qkv_format: str = "sbhd",
     ) -> torch.Tensor:
         """core attention fprop"""
-        batch_size, seqlen = query_layer.shape[1], query_layer.shape[0]
+        if self.use_torch_compile and not torch.onnx.is_in_onnx_export():
+            return _compiled(UnfusedDotProductAttention._attention_forward)(
+                self, query_layer, key_layer, value_layer, attention_mask, qkv_format
+            )
+        return self._attention_forward(
+            query_layer, key_layer, value_layer, attention_mask, qkv_format
+        )
+
+    def _attention_forward(
+        self,
+        query_layer: torch.Tensor,
+        key_layer: torch.Tensor,
+        value_layer: torch.Tensor,
+        attention_mask: Optional[torch.Tensor],
+        qkv_format: str,
+    ) -> torch.Tensor:
+        """core attention fprop on [s, b, np, hn] or [b, s, np, hn] inputs"""
+        if qkv_format == "bshd":
+            # [b, s, np, hn] --> [b, np, s, hn]
+            query_layer, key_layer, value_layer = [
+                x.transpose(1, 2) for x in (query_layer, key_layer, value_layer)
+            ]
+        else:
+            # [s, b, np, hn] --> [b, np, s, hn]
+            query_layer, key_layer, value_layer = [
+                x.permute(1, 2, 0, 3) for x in (query_layer, key_layer, value_layer)
+            ]
+
+        if self.use_sdpa and not torch.onnx.is_in_onnx_export():
+            sdpa_mask_args = self._get_sdpa_mask_args(query_layer, key_layer, attention_mask)
+            if sdpa_mask_args is not None:
+                return self._sdpa_forward(
+                    query_layer, key_layer, value_layer, *sdpa_mask_args
+                )
+
+        batch_size, seqlen = query_layer.shape[0], query_layer.shape[2]
 
         # [b, np, sq, sk]
         output_size = (
+            query_layer.size(0),
             query_layer.size(1),
             query_layer.size(2),
-            query_layer.size(0),
-            key_layer.size(0),
+            key_layer.size(2),
         )
 
-        # [sq, b, np, hn] -> [sq, b * np, hn]
-        query_layer = query_layer.view(
-            output_size[2], output_size[0] * output_size[1], -1
-        )
-        # [sk, b, np, hn] -> [sk, b * np, hn]
-        key_layer = key_layer.view(output_size[3], output_size[0] * output_size[1], -1)
-
-        # preallocting result tensor: [b * np, sq, sk]
-        matmul_result = torch.empty(
-            output_size[0] * output_size[1],
-            output_size[2],
-            output_size[3],
-            dtype=query_layer.dtype,
-            device=torch.cuda.current_device(),
-        )
+        # [b, np, s, hn] -> [b * np, s, hn]
+        # For sbhd inputs, b and np of the permuted QKV projection output views
+        # merge without a copy. For bshd inputs s lies between them in memory, so
+        # Q, K and V are copied here; a 4D matmul would fold its batch dims with
+        # the same copies.
+        query_layer, key_layer, value_layer = [
+            x.reshape(output_size[0] * output_size[1], x.size(2), x.size(3))
+            for x in (query_layer, key_layer, value_layer)
+        ]
+
+        # With beta=0 baddbmm ignores its input, which only has to broadcast to
+        # [b * np, sq, sk]; a single element avoids allocating a second scores
+        # sized buffer while keeping the scaling fused into the GEMM.
+        matmul_input = torch.empty(1, 1, 1, dtype=query_layer.dtype, device=query_layer.device)
 
         # Raw attention scores. [b * np, sq, sk]
         matmul_result = torch.baddbmm(
-            matmul_result,
-            query_layer.transpose(0, 1),  # [b * np, sq, hn]
-            key_layer.transpose(0, 1).transpose(1, 2),  # [b * np, hn, sk]
+            matmul_input,
+            query_layer,  # [b * np, sq, hn]
+            key_layer.transpose(1, 2),  # [b * np, hn, sk]
             beta=0.0,
             alpha=(1.0 / self.norm_factor),
         )
@@ -158,42 +304,121 @@ class UnfusedDotProductAttention(torch.nn.Module):
 
         # This is actually dropping out entire tokens to attend to, which might
         # seem a bit unusual, but is taken from the original Transformer paper.
-        with self.attention_dropout_ctx():
-            attention_probs = self.attention_dropout(attention_probs)
-
-        # value_layer -> context layer.
-        # [sk, b, np, hn] --> [b, np, sq, hn]
-        output_size = (
-            value_layer.size(1),
-            value_layer.size(2),
-            query_layer.size(0),
-            value_layer.size(3),
-        )
-
-        # change view [sk, b * np, hn]
-        value_layer = value_layer.view(
-            value_layer.size(0), output_size[0] * output_size[1], -1
-        )
+        # The RNG state is only forked when dropout is actually applied.
+        if self.training and self.attention_dropout.p > 0.0:
+            with self.attention_dropout_ctx():
+                attention_probs = self.attention_dropout(attention_probs)
 
         # change view [b * np, sq, sk]
         attention_probs = attention_probs.view(
             output_size[0] * output_size[1], output_size[2], -1
         )
 
-        # matmul: [b * np, sq, hn]
-        context_layer = torch.bmm(attention_probs, value_layer.transpose(0, 1))
+        if (
+            attention_probs.dtype == value_layer.dtype
+            and not torch.onnx.is_in_onnx_export()
+        ):
+            # matmul: [sq, b * np, hn]
+            context_layer = _SBHDOutputBMM.apply(attention_probs, value_layer)
+        else:
+            # matmul: [b * np, sq, hn]
+            context_layer = torch.bmm(attention_probs, value_layer)
 
-        # change view [b, np, sq, hn]
-        context_layer = context_layer.view(*output_size)
+            # change view [b, np, sq, hn]
+            context_layer = context_layer.view(*output_size[:3], -1)
 
-        # [b, np, sq, hn] --> [sq, b, np, hn]
-        context_layer = context_layer.permute(2, 0, 1, 3).contiguous()
+            # [b, np, sq, hn] --> [sq, b, np, hn]
+            context_layer = context_layer.permute(2, 0, 1, 3).contiguous()
 
         # [sq, b, np, hn] --> [sq, b, hp]
         context_layer = context_layer.view(seqlen, batch_size, -1)
 
         return context_layer
 
+    def _get_sdpa_mask_args(
+        self,
+        query_layer: torch.Tensor,
+        key_layer: torch.Tensor,
+        attention_mask: Optional[torch.Tensor],
+    ) -> Optional[Tuple[Optional[torch.Tensor], bool]]:
+        """The `attn_mask` and `is_causal` arguments with which SDPA computes the same
+        function as `scale_mask_softmax`, or `None` if there are none."""
+        b, np, sq, _ = query_layer.shape
+        sk = key_layer.size(2)
+
+        # The fused causal softmax kernel ignores the mask. When the kernel is not
+        # available, the mask is applied as is, whatever the mask type.
+        if (
+            self.attn_mask_type == "causal"
+            and sq == sk
+            and self.scale_mask_softmax.is_kernel_available(b, np, sq, sk, query_layer.dtype)
+        ):
+            return None, True
+        if attention_mask is None:
+            return None, False
+        attn_mask = self._get_sdpa_mask(attention_mask)
+        if attn_mask is None:
+            return None
+        return attn_mask, False
+
+    def _get_sdpa_mask(self, attention_mask: torch.Tensor) -> Optional[torch.Tensor]:
+        """Invert `attention_mask` for SDPA, or return `None` if it masks out all keys
+        of some query. Softmax gives such rows a uniform distribution after filling the
+        masked scores with -10000, whereas SDPA produces NaN. The check synchronizes
+        with the device, so its result is reused while the same, unmodified mask is
+        passed in, e.g. across decode steps or microbatches."""
+        # Static masks are refilled in place between CUDA graph replays,
+        # so neither the check nor the cache can be captured.
+        if attention_mask.is_cuda and torch.cuda.is_current_stream_capturing():
+            return None
+
+        cache = self._sdpa_mask_cache
+        if (
+            cache is not None
+            and cache[0] is attention_mask
+            and cache[1] == attention_mask._version
+        ):
+            return cache[2]
+
+        attn_mask = None
+        if not attention_mask.all(dim=-1).any():
+            # TE masks out `True` entries, whereas SDPA keeps them.
+            attn_mask = torch.logical_not(attention_mask)
+        self._sdpa_mask_cache = (attention_mask, attention_mask._version, attn_mask)
+        return attn_mask
+
+    def _sdpa_forward(
+        self,
+        query_layer: torch.Tensor,
+        key_layer: torch.Tensor,
+        value_layer: torch.Tensor,
+        attn_mask: Optional[torch.Tensor],
+        is_causal: bool,
+    ) -> torch.Tensor:
+        """core attention fprop on [b, np, s, hn] inputs using
+        `torch.nn.functional.scaled_dot_product_attention` which avoids
+        materializing the [b, np, sq, sk] attention scores when a fused
+        backend is available.
+        """
+        batch_size, seqlen = query_layer.shape[0], query_layer.shape[2]
+
+        # The default SDPA scale of 1/sqrt(hn) equals the product of the BMM1 scale
+        # and the softmax scale, with or without query-key layer scaling.
+        dropout_p = self.attention_dropout.p if self.training else 0.0
+        dropout_ctx = self.attention_dropout_ctx if dropout_p > 0.0 else nullcontext
+        with dropout_ctx():
+            context_layer = torch.nn.functional.scaled_dot_product_attention(
+                query_layer,
+                key_layer,
+                value_layer,
+                attn_mask=attn_mask,
+                dropout_p=dropout_p,
+                is_causal=is_causal,
+            )
+
+        # [b, np, sq, hn] --> [sq, b, np, hn] --> [sq, b, hp]
+        return context_layer.permute(2, 0, 1, 3).reshape(seqlen, batch_size, -1)
+
 
 class FlashAttention(torch.nn.Module):
     """Dot product attention implementation by using the flash-attn package.
@@ -211,7 +436,7 @@ class FlashAttention(torch.nn.Module):
     ) -> None:
         super().__init__()
 
-        if "dev" not in _flash_attn_version:
+        if not _flash_attn_version_supported:
             raise ImportError(
                 'Please install correct version of flash-attn with ' \
                 'pip install git+https://github.com/ksivaman/flash-attention.git@hopper. ' \
@@ -220,16 +445,39 @@ class FlashAttention(torch.nn.Module):
         assert (
             attn_mask_type == "causal"
             ), 'FlashAttention currently only supports causal attention mask.'
-        assert (
-            attention_softmax_in_fp32
-            ), 'FlashAttention currently only supports softmax compute in fp32.'
 
         self.attn_causal_mask = attn_mask_type == "causal"
         self.norm_factor = norm_factor
+        self.softmax_scale = 1.0 / norm_factor
         self.attention_dropout_ctx = attention_dropout_ctx
         self.attention_dropout = attention_dropout
         self.layer_number = layer_number
         self.apply_query_key_layer_scaling = apply_query_key_layer_scaling
+        # Unused by the kernel: flash-attn computes softmax in fp32 regardless.
+        self.attention_softmax_in_fp32 = attention_softmax_in_fp32
+        self._cu_seqlens_cache = OrderedDict()
+
+    def _get_cu_seqlens(
+        self, batch_size: int, seqlen: int, device: torch.device
+    ) -> torch.Tensor:
+        """Cumulative sequence lengths for `batch_size` sequences of length `seqlen`,
+        cached for the most recently used shapes."""
+        key = (batch_size, seqlen, device)
+        cu_seqlens = self._cu_seqlens_cache.get(key)
+        if cu_seqlens is not None:
+            self._cu_seqlens_cache.move_to_end(key)
+            return cu_seqlens
+
+        cu_seqlens = torch.arange(
+            0,
+            (batch_size + 1) * seqlen,
+            step=seqlen,
+            dtype=torch.int32,
+            device=device)
+        self._cu_seqlens_cache[key] = cu_seqlens
+        if len(self._cu_seqlens_cache) > _CU_SEQLENS_CACHE_SIZE:
+            self._cu_seqlens_cache.popitem(last=False)
+        return cu_seqlens
 
     def forward(
         self,
@@ -237,6 +485,7 @@ class FlashAttention(torch.nn.Module):
         key_layer: torch.Tensor,
         value_layer: torch.Tensor,
         attention_mask: Optional[torch.Tensor] = None,
+        qkv_format: str = "sbhd",
     ) -> torch.Tensor:
         """flash-attn fprop"""
 
@@ -252,30 +501,29 @@ class FlashAttention(torch.nn.Module):
             attention_mask is None
         ), 'FlashAttention currently does not support external attention mask.'
 
-        query_layer, key_layer, value_layer = [x.transpose(0,1).contiguous()
-                       for x in (query_layer, key_layer, value_layer)]
+        if qkv_format == "sbhd":
+            # [sq, b, np, hn] -> [b, sq, np, hn]
+            query_layer, key_layer, value_layer = [x.transpose(0,1).contiguous()
+                           for x in (query_layer, key_layer, value_layer)]
 
         batch_size, seqlen = query_layer.shape[0], query_layer.shape[1]
 
-        # [b, sq, np, hn]
+        # [b, sq, np, hn] -> [(b sq), np, hn]
         query_layer, key_layer, value_layer = [
-            x.view(x.shape[0] * x.shape[1], *x.shape[2:])
+            x.reshape(x.shape[0] * x.shape[1], *x.shape[2:])
             for x in [query_layer, key_layer, value_layer]
         ]
 
         max_seqlen = seqlen
-        cu_seqlens = torch.arange(
-            0,
-            (batch_size + 1) * seqlen,
-            step=seqlen,
-            dtype=torch.int32,
-            device=query_layer.device)
+        cu_seqlens = self._get_cu_seqlens(batch_size, seqlen, query_layer.device)
 
-        with self.attention_dropout_ctx():
+        dropout_p = self.attention_dropout if self.training else 0.0
+        dropout_ctx = self.attention_dropout_ctx if dropout_p > 0.0 else nullcontext
+        with dropout_ctx():
             output = flash_attn_unpadded_func(
                 query_layer, key_layer, value_layer, cu_seqlens, cu_seqlens, max_seqlen, max_seqlen,
-                self.attention_dropout if self.training else 0.0,
-                softmax_scale=1.0/self.norm_factor, causal=self.attn_causal_mask
+                dropout_p,
+                softmax_scale=self.softmax_scale, causal=self.attn_causal_mask
             )
 
         # [(b sq), np, hn] -> [sq, b, (np hn)]
@@ -293,7 +541,14 @@ class DotProductAttention(torch.nn.Module):
         `flash-attn <https://github.com/ksivaman/flash-attention>`_ whenever possible in order to
         achieve optimal performance. To observe deterministic behavior, set the environment
         variable :attr:`NVTE_ALLOW_NONDETERMINISTIC_ALGO=0`. In order to disable
-        `flash-attn` entirely, set :attr:`NVTE_FLASH_ATTN=0`.
+        `flash-attn` entirely, set :attr:`NVTE_FLASH_ATTN=0`. When `flash-attn` cannot be
+        used, PyTorch's `scaled_dot_product_attention` is called if available and computes
+        the same function as the unfused BMM-softmax-BMM implementation for the given mask
+        and inputs; set :attr:`NVTE_USE_SDPA=0` to always use the unfused implementation.
+        Setting :attr:`NVTE_COMPILE_UNFUSED_ATTN=1` compiles the non flash-attn path with
+        `torch.compile` when available. :attr:`NVTE_FLASH_ATTN`, :attr:`NVTE_USE_SDPA` and
+        :attr:`NVTE_COMPILE_UNFUSED_ATTN` are read when `transformer_engine` is imported and
+        must be set before then.
 
     Parameters
     ----------
@@ -311,7 +566,9 @@ class DotProductAttention(torch.nn.Module):
                                   by a factor of `layer_number`
     attention_softmax_in_fp32: bool, default = `True`
                               if set to `False`, softmax is executed in
-                              the dtype of activation tensors.
+                              the dtype of activation tensors. Has no effect
+                              when flash-attn is used, which always computes
+                              softmax in fp32.
     attn_mask_type: {'causal', 'padding'}, default = `causal`
                    type of attention mask passed into softmax operation.
 
@@ -369,11 +626,14 @@ class DotProductAttention(torch.nn.Module):
         if apply_query_key_layer_scaling:
             norm_factor *= layer_number
 
+        # flash-attn kernels only exist for head dims up to 128 that are a
+        # multiple of 8; other head dims go to SDPA or the unfused path.
         self.use_flash_attention = (
-            int(os.getenv("NVTE_FLASH_ATTN", "1"))
-            and attention_softmax_in_fp32
+            _NVTE_FLASH_ATTN
             and attn_mask_type == "causal"
             and not apply_query_key_layer_scaling
+            and self.hidden_size_per_attention_head % 8 == 0
+            and self.hidden_size_per_attention_head <= 128
         )
 
         attn_kwargs = {
@@ -395,11 +655,12 @@ class DotProductAttention(torch.nn.Module):
         self,
         attention_func: Callable,
         *forward_args: Tuple[torch.Tensor, ...],
+        **forward_kwargs: Dict[str, Any],
     ) -> torch.Tensor:
         """Forward method with activation checkpointing."""
 
-        def custom_forward(*inputs):
-            return attention_func(*inputs)
+        def custom_forward(*inputs, **kwargs):
+            return attention_func(*inputs, **kwargs)
 
         hidden_states = checkpoint(
             custom_forward,
@@ -407,10 +668,25 @@ class DotProductAttention(torch.nn.Module):
             self.get_rng_state_tracker,
             self.tp_group,
             *forward_args,
+            **forward_kwargs,
         )
 
         return hidden_states
 
+    def set_tensor_parallel_group(self, tp_group: Union[dist_group_type, None]) -> None:
+        """Set TP group"""
+        self.tp_group = tp_group
+
+    def _use_flash_attention(
+        self,
+        attention_mask: Optional[torch.Tensor],
+        *dtypes: torch.dtype,
+    ) -> bool:
+        """Check whether flash-attn can be used for the given mask and input dtypes."""
+        if not self.use_flash_attention:
+            return False
+        return attention_mask is None and _FLASH_ATTN_DTYPES.issuperset(dtypes)
+
     def forward(
         self,
         query_layer: torch.Tensor,
@@ -418,6 +694,7 @@ class DotProductAttention(torch.nn.Module):
         value_layer: torch.Tensor,
         attention_mask: Optional[torch.Tensor] = None,
         checkpoint_core_attention: bool = False,
+        qkv_format: str = "sbhd",
     ) -> torch.Tensor:
         """
         Dot Product Attention Layer.
@@ -426,7 +703,9 @@ class DotProductAttention(torch.nn.Module):
 
             Input tensors :attr:`query_layer`, :attr:`key_layer`, and :attr:`value_layer`
             must each be of shape (:attr:`sequence_length`, :attr:`batch_size`,
-            :attr:`num_attention_heads`, :attr:`kv_channels`). Output of shape
+            :attr:`num_attention_heads`, :attr:`kv_channels`), or of shape
+            (:attr:`batch_size`, :attr:`sequence_length`, :attr:`num_attention_heads`,
+            :attr:`kv_channels`) when :attr:`qkv_format` is `bshd`. Output of shape
             (:attr:`sequence_length`, :attr:`batch_size`, :attr:`num_attention_heads`
             * :attr:`kv_channels`) is returned.
 
@@ -445,23 +724,27 @@ class DotProductAttention(torch.nn.Module):
                                    during the backward pass in order to save memory that would
                                    otherwise be occupied to store the forward activations until
                                    backprop.
+        qkv_format : {'sbhd', 'bshd'}, default = `sbhd`
+                    memory layout of the query, key and value tensors. `bshd` lets
+                    callers hand over tensors already laid out for flash-attn, which
+                    skips transposing each of them before the kernel call.
         """
 
-        use_flash_attention = self.use_flash_attention
-        if (attention_mask is not None
-            or query_layer.dtype not in [torch.bfloat16, torch.float16]
-            or key_layer.dtype not in [torch.bfloat16, torch.float16]
-            or value_layer.dtype not in [torch.bfloat16, torch.float16]
-        ):
-            use_flash_attention = False
+        assert (
+            qkv_format in QKVFormats
+        ), f"qkv_format {qkv_format} not supported"
 
-        if use_flash_attention:
+        if self._use_flash_attention(
+            attention_mask, query_layer.dtype, key_layer.dtype, value_layer.dtype
+        ):
             if checkpoint_core_attention:
                 return self._checkpointed_attention_forward(self.flash_attention,
                                                             query_layer,
                                                             key_layer,
-                                                            value_layer)
-            return self.flash_attention(query_layer, key_layer, value_layer)
+                                                            value_layer,
+                                                            qkv_format=qkv_format)
+            return self.flash_attention(query_layer, key_layer, value_layer,
+                                        qkv_format=qkv_format)
 
         if checkpoint_core_attention:
             return self._checkpointed_attention_forward(
@@ -470,8 +753,11 @@ class DotProductAttention(torch.nn.Module):
                 key_layer,
                 value_layer,
                 attention_mask,
+                qkv_format=qkv_format,
             )
-        return self.unfused_attention(query_layer, key_layer, value_layer, attention_mask)
+        return self.unfused_attention(
+            query_layer, key_layer, value_layer, attention_mask, qkv_format=qkv_format
+        )
 
 
 class MultiHeadAttention(torch.nn.Module):
@@ -526,6 +812,12 @@ class MultiHeadAttention(torch.nn.Module):
         self.hidden_size_per_attention_head = kv_channels
         self.num_attention_heads_per_partition = divide(num_attention_heads, tp_size)
 
+        # Single token inference steps (KV cache update and core attention)
+        # captured into CUDA graphs, keyed on the cache, batch and input shapes.
+        self._decode_graphs = (
+            OrderedDict() if _NVTE_CUDA_GRAPH_DECODE else None
+        )
+
         common_gemm_kwargs = {
             "fuse_wgrad_accumulation": fuse_wgrad_accumulation,
             "tp_group": tp_group,
@@ -624,22 +916,198 @@ class MultiHeadAttention(torch.nn.Module):
             **common_gemm_kwargs,
         )
 
+        # Submodules that hold a reference to the TP group.
+        self._tp_children = [
+            module
+            for module in (
+                getattr(self, name, None)
+                for name in (
+                    "layernorm_qkv",
+                    "qkv",
+                    "layernorm_query",
+                    "query_layer",
+                    "key_value",
+                    "core_attention",
+                    "proj",
+                )
+            )
+            if module is not None
+        ]
+
 
     def _allocate_memory(
-        self, inference_max_sequence_len: int, batch_size: int
-    ) -> torch.Tensor:
-        return torch.empty(
+        self, inference_max_sequence_len: int, batch_size: int, device: torch.device
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        """Allocate the key and value caches as the two halves of a single
+        [2, s, b, np, hn] buffer so that both can be updated with one copy.
+        The buffer is zeroed since CUDA graph decode steps attend over the
+        whole cache, and masked out garbage values could still turn into NaN.
+        Decode graphs captured for previous caches are released."""
+        if self._decode_graphs is not None:
+            self._decode_graphs.clear()
+        kv_memory = torch.zeros(
+            2,
             inference_max_sequence_len,
             batch_size,
             self.num_attention_heads_per_partition,
             self.hidden_size_per_attention_head,
             dtype=self.params_dtype,
-            device=torch.cuda.current_device(),
+            device=device,
+        )
+        return kv_memory[0], kv_memory[1]
+
+    def _update_kv_cache(
+        self,
+        inference_key_memory: torch.Tensor,
+        inference_value_memory: torch.Tensor,
+        batch_start: int,
+        sequence_start: int,
+        mixed_kv_layer: torch.Tensor,
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        """Write the [sk, b, np, 2 * hn] keys and values of the current step into
+        the inference caches and return the cached keys and values seen so far."""
+        # [sk, b, np, 2 * hn] --> [sk, b, np, 2, hn]
+        kv_layer = mixed_kv_layer.view(
+            *mixed_kv_layer.shape[:-1], 2, self.hidden_size_per_attention_head
+        )
+        batch_end = batch_start + kv_layer.size(1)
+        assert batch_end <= inference_key_memory.size(1)
+        sequence_end = sequence_start + kv_layer.size(0)
+        assert sequence_end <= inference_key_memory.size(0)
+        # Copy key and values.
+        kv_memory = inference_key_memory._base
+        if (
+            kv_memory is not None
+            and kv_memory.shape == (2,) + inference_key_memory.shape
+            and kv_memory[0].data_ptr() == inference_key_memory.data_ptr()
+            and kv_memory[1].data_ptr() == inference_value_memory.data_ptr()
+        ):
+            # [sk, b, np, 2, hn] --> [2, sk, b, np, hn]
+            kv_memory[
+                :, sequence_start:sequence_end, batch_start:batch_end, ...
+            ] = kv_layer.permute(3, 0, 1, 2, 4)
+        else:
+            key_layer, value_layer = kv_layer.unbind(-2)
+            inference_key_memory[
+                sequence_start:sequence_end, batch_start:batch_end, ...
+            ] = key_layer
+            inference_value_memory[
+                sequence_start:sequence_end, batch_start:batch_end, ...
+            ] = value_layer
+        key_layer = inference_key_memory[:sequence_end, batch_start:batch_end, ...]
+        value_layer = inference_value_memory[:sequence_end, batch_start:batch_end, ...]
+        return key_layer, value_layer
+
+    def _decode_step(
+        self,
+        inference_key_memory: torch.Tensor,
+        inference_value_memory: torch.Tensor,
+        batch_start: int,
+        sequence_offset: torch.Tensor,
+        query_layer: torch.Tensor,
+        mixed_kv_layer: torch.Tensor,
+    ) -> torch.Tensor:
+        """Single token inference step with static shapes: write the keys and values
+        at `sequence_offset`, a one element device tensor, into the caches and attend
+        to the whole caches, masking out the positions after it."""
+        # [1, b, np, 2 * hn] --> 2 [1, b, np, hn]
+        key_layer, value_layer = mixed_kv_layer.view(
+            *mixed_kv_layer.shape[:-1], 2, self.hidden_size_per_attention_head
+        ).unbind(-2)
+        batch_end = batch_start + key_layer.size(1)
+        key_memory = inference_key_memory[:, batch_start:batch_end, ...]
+        value_memory = inference_value_memory[:, batch_start:batch_end, ...]
+        key_memory.index_copy_(0, sequence_offset, key_layer)
+        value_memory.index_copy_(0, sequence_offset, value_layer)
+
+        # [1, 1, 1, sk]
+        attention_mask = (
+            torch.arange(key_memory.size(0), device=sequence_offset.device) > sequence_offset
+        ).view(1, 1, 1, -1)
+        return self.core_attention(query_layer, key_memory, value_memory, attention_mask)
+
+    def _use_decode_graph(
+        self,
+        attention_mask: Optional[torch.Tensor],
+        query_layer: torch.Tensor,
+        mixed_kv_layer: torch.Tensor,
+    ) -> bool:
+        """Check whether an inference step can be replayed from a CUDA graph."""
+        if self._decode_graphs is None or self.training or torch.is_grad_enabled():
+            return False
+        return (
+            attention_mask is None
+            and query_layer.size(0) == 1
+            and mixed_kv_layer.size(0) == 1
+        )
+
+    def _decode_graph(
+        self,
+        inference_key_memory: torch.Tensor,
+        inference_value_memory: torch.Tensor,
+        batch_start: int,
+        sequence_start: int,
+        query_layer: torch.Tensor,
+        mixed_kv_layer: torch.Tensor,
+    ) -> torch.Tensor:
+        """`_decode_step` replayed from a CUDA graph that is captured once per cache,
+        batch and input shapes, and reused for every position in the sequence."""
+        assert sequence_start < inference_key_memory.size(0)
+        key = (
+            inference_key_memory.data_ptr(),
+            inference_value_memory.data_ptr(),
+            inference_key_memory.shape,
+            batch_start,
+            query_layer.shape,
+            mixed_kv_layer.shape,
+            query_layer.dtype,
         )
+        inputs = (query_layer, mixed_kv_layer)
+        entry = self._decode_graphs.get(key)
+        if entry is not None:
+            self._decode_graphs.move_to_end(key)
+            graph, static_offset, static_inputs, static_output = entry
+            static_offset.fill_(sequence_start)
+            for static_input, inp in zip(static_inputs, inputs):
+                static_input.copy_(inp)
+            graph.replay()
+            return static_output
+
+        static_offset = torch.full(
+            (1,), sequence_start, dtype=torch.int64, device=query_layer.device
+        )
+        static_inputs = tuple(inp.clone() for inp in inputs)
+        decode_args = (
+            inference_key_memory,
+            inference_value_memory,
+            batch_start,
+            static_offset,
+        ) + static_inputs
+
+        # Warm up on a side stream before capture, as required by CUDA graphs.
+        stream = torch.cuda.Stream()
+        stream.wait_stream(torch.cuda.current_stream())
+        with torch.cuda.stream(stream):
+            self._decode_step(*decode_args)
+        torch.cuda.current_stream().wait_stream(stream)
+
+        graph = torch.cuda.CUDAGraph()
+        with torch.cuda.graph(graph):
+            static_output = self._decode_step(*decode_args)
+        graph.replay()
+
+        # The caches are not referenced, so that they are freed with the
+        # inference params. Graphs for them are dropped in `_allocate_memory`.
+        self._decode_graphs[key] = (graph, static_offset, static_inputs, static_output)
+        if len(self._decode_graphs) > _DECODE_GRAPH_CACHE_SIZE:
+            self._decode_graphs.popitem(last=False)
+        return static_output
 
     def set_tensor_parallel_group(self, tp_group: Union[dist_group_type, None]) -> None:
         """Set TP group"""
         self.tp_group = tp_group
+        for child in self._tp_children:
+            child.set_tensor_parallel_group(tp_group)
 
     def forward(
         self,
@@ -653,6 +1121,7 @@ class MultiHeadAttention(torch.nn.Module):
         """MultiHeadAttention FWD"""
         # hidden_states: [sq, b, h]
 
+        # Also validates the masks passed to TransformerLayer.
         if attention_mask is not None:
             assert (
                 attention_mask.dtype == torch.bool
@@ -666,11 +1135,8 @@ class MultiHeadAttention(torch.nn.Module):
             if self.layer_number not in inference_params.key_value_memory_dict:
                 inf_max_seq_len = inference_params.max_sequence_len
                 inf_max_batch_size = inference_params.max_batch_size
-                inference_key_memory = self._allocate_memory(
-                    inf_max_seq_len, inf_max_batch_size
-                )
-                inference_value_memory = self._allocate_memory(
-                    inf_max_seq_len, inf_max_batch_size
+                inference_key_memory, inference_value_memory = self._allocate_memory(
+                    inf_max_seq_len, inf_max_batch_size, hidden_states.device
                 )
                 inference_params.key_value_memory_dict[self.layer_number] = (
                     inference_key_memory,
@@ -686,11 +1152,36 @@ class MultiHeadAttention(torch.nn.Module):
         # Query, Key, and Value
         # =====================
 
+        qkv_format = "sbhd"
         if self.attention_type == "self":
+            # flash-attn consumes [b, sq, np, hn] tensors.
+            activation_dtype = (
+                torch.get_autocast_gpu_dtype()
+                if torch.is_autocast_enabled()
+                else hidden_states.dtype
+            )
+            use_flash_attention = not (
+                inference_params and self.layer_number is not None
+            ) and self.core_attention._use_flash_attention(attention_mask, activation_dtype)
+
+            # Transposing the [sq, b, h] input is cheaper than transposing the
+            # [sq, b, 3 * h] projection output. This is not possible when the input
+            # is gathered along the sequence dimension or the layernorm output is
+            # returned in the [sq, b, h] layout.
+            qkv_input = hidden_states
+            if (
+                use_flash_attention
+                and not self.sequence_parallel
+                and not (self.input_layernorm and self.return_layernorm_output)
+            ):
+                # [sq, b, h] --> [b, sq, h]
+                qkv_input = hidden_states.transpose(0, 1).contiguous()
+                qkv_format = "bshd"
+
             # Attention heads [sq, b, h] --> [sq, b, (np * 3 * hn)]
             if self.input_layernorm:
                 layernorm_qkv_outputs = self.layernorm_qkv(
-                    hidden_states,
+                    qkv_input,
                     is_first_microbatch=is_first_microbatch,
                 )
                 if self.return_layernorm_output:
@@ -699,7 +1190,7 @@ class MultiHeadAttention(torch.nn.Module):
                     mixed_x_layer = layernorm_qkv_outputs
             else:
                 mixed_x_layer = self.qkv(
-                    hidden_states,
+                    qkv_input,
                     is_first_microbatch=is_first_microbatch,
                 )
 
@@ -708,12 +1199,21 @@ class MultiHeadAttention(torch.nn.Module):
                 self.num_attention_heads_per_partition,
                 3 * self.hidden_size_per_attention_head,
             )
-            mixed_x_layer = mixed_x_layer.view(*new_tensor_shape)
+            mixed_x_layer = mixed_x_layer.reshape(*new_tensor_shape)
+
+            # Otherwise transpose the packed QKV tensor once here instead of
+            # transposing Q, K, and V separately.
+            if use_flash_attention and qkv_format == "sbhd":
+                # [sq, b, np, 3 * hn] --> [b, sq, np, 3 * hn]
+                mixed_x_layer = mixed_x_layer.transpose(0, 1).contiguous()
+                qkv_format = "bshd"
 
             # [sq, b, np, 3 * hn] --> 3 [sq, b, np, hn]
-            query_layer, key_layer, value_layer = split_tensor_along_last_dim(
-                mixed_x_layer, 3
-            )
+            query_layer, key_layer, value_layer = mixed_x_layer.view(
+                *mixed_x_layer.shape[:-1], 3, self.hidden_size_per_attention_head
+            ).unbind(-2)
+            # [sq, b, np, 2 * hn] view of the key and value
+            mixed_kv_layer = mixed_x_layer[..., self.hidden_size_per_attention_head:]
         else:
             # Attention heads [sk, b, h] --> [sk, b, (np * 2 * hn)]
             mixed_kv_layer = self.key_value(
@@ -726,10 +1226,12 @@ class MultiHeadAttention(torch.nn.Module):
                 self.num_attention_heads_per_partition,
                 2 * self.hidden_size_per_attention_head,
             )
-            mixed_kv_layer = mixed_kv_layer.view(*new_tensor_shape)
+            mixed_kv_layer = mixed_kv_layer.reshape(*new_tensor_shape)
 
             # [sk, b, np, 2 * hn] --> 2 [sk, b, np, hn]
-            (key_layer, value_layer) = split_tensor_along_last_dim(mixed_kv_layer, 2)
+            key_layer, value_layer = mixed_kv_layer.view(
+                *mixed_kv_layer.shape[:-1], 2, self.hidden_size_per_attention_head
+            ).unbind(-2)
 
             # Attention head [sq, b, h] --> [sq, b, hp]
             if self.input_layernorm:
@@ -752,42 +1254,47 @@ class MultiHeadAttention(torch.nn.Module):
                 self.num_attention_heads_per_partition,
                 self.hidden_size_per_attention_head,
             )
-            query_layer = query_layer.view(*new_tensor_shape)
+            query_layer = query_layer.reshape(*new_tensor_shape)
 
         # ==================================
         # Adjust key and value for inference
         # ==================================
 
+        context_layer = None
         if inference_params and self.layer_number is not None:
             batch_start = inference_params.batch_size_offset
-            batch_end = batch_start + key_layer.size(1)
-            assert batch_end <= inference_key_memory.size(1)
             sequence_start = inference_params.sequence_len_offset
-            sequence_end = sequence_start + key_layer.size(0)
-            assert sequence_end <= inference_key_memory.size(0)
-            # Copy key and values.
-            inference_key_memory[
-                sequence_start:sequence_end, batch_start:batch_end, ...
-            ] = key_layer
-            inference_value_memory[
-                sequence_start:sequence_end, batch_start:batch_end, ...
-            ] = value_layer
-            key_layer = inference_key_memory[:sequence_end, batch_start:batch_end, ...]
-            value_layer = inference_value_memory[
-                :sequence_end, batch_start:batch_end, ...
-            ]
+            if self._use_decode_graph(attention_mask, query_layer, mixed_kv_layer):
+                context_layer = self._decode_graph(
+                    inference_key_memory,
+                    inference_value_memory,
+                    batch_start,
+                    sequence_start,
+                    query_layer,
+                    mixed_kv_layer,
+                )
+            else:
+                key_layer, value_layer = self._update_kv_cache(
+                    inference_key_memory,
+                    inference_value_memory,
+                    batch_start,
+                    sequence_start,
+                    mixed_kv_layer,
+                )
 
         # ==================================
         # core attention computation
         # ==================================
 
-        context_layer = self.core_attention(
-            query_layer,
-            key_layer,
-            value_layer,
-            attention_mask,
-            checkpoint_core_attention=checkpoint_core_attention,
-        )
+        if context_layer is None:
+            context_layer = self.core_attention(
+                query_layer,
+                key_layer,
+                value_layer,
+                attention_mask,
+                checkpoint_core_attention=checkpoint_core_attention,
+                qkv_format=qkv_format,
+            )
 
         # =================
         # Output. [sq, b, h]
@@ -807,6 +1314,25 @@ class TransformerLayer(torch.nn.Module):
     TransformerLayer is made up of an attention block and a feedforward network (MLP).
     This standard layer is based on the paper "Attention Is All You Need".
 
+    .. note::
+
+        When running inference with a KV cache under `torch.no_grad()`, setting
+        :attr:`NVTE_CUDA_GRAPH_DECODE=1` captures the KV cache update and core attention
+        of single token steps without an attention mask into a CUDA graph, which is
+        replayed for all later steps with the same cache, batch and input shapes. The
+        captured attention spans the whole cache, with positions after the current
+        one masked out. Graphs do not keep their KV cache alive; they are released
+        when the layer allocates the cache for new inference params, so each new
+        generation captures its graphs again. The variable is read when
+        `transformer_engine` is imported and must be set before then.
+
+    .. note::
+
+        Setting :attr:`NVTE_TORCH_COMPILE=1` runs the layer's forward through
+        `torch.compile` with dynamic sequence and batch dimensions when available.
+        The variable is read when `transformer_engine` is imported and must be set
+        before then.
+
     Parameters
     ----------
     hidden_size : int
@@ -941,10 +1467,11 @@ class TransformerLayer(torch.nn.Module):
     ) -> None:
         super().__init__()
 
-        bias_dropout_fusion = bool(int(os.getenv("NVTE_BIAS_DROPOUT_FUSION", "1")))
+        bias_dropout_fusion = _NVTE_BIAS_DROPOUT_FUSION
         self.layer_number = layer_number
         self.output_layernorm = output_layernorm
         self.layer_type = layer_type
+        self._is_decoder = layer_type == "decoder"
         self.apply_residual_connection_post_layernorm = (
             apply_residual_connection_post_layernorm
         )
@@ -1005,7 +1532,7 @@ class TransformerLayer(torch.nn.Module):
             attention_type="self",
         )
 
-        if layer_type == "decoder":
+        if self._is_decoder:
             self.inter_attention = MultiHeadAttention(
                 *attention_args,
                 **common_attention_kwargs,
@@ -1043,13 +1570,20 @@ class TransformerLayer(torch.nn.Module):
         self.drop_path = DropPath(drop_path_rate) if drop_path_rate > 0.0 else None
 
         # Set bias+dropout+add fusion grad_enable execution handler.
-        TORCH_MAJOR = int(torch.__version__.split(".")[0])
-        TORCH_MINOR = int(torch.__version__.split(".")[1])
-        use_nvfuser = TORCH_MAJOR > 1 or (TORCH_MAJOR == 1 and TORCH_MINOR >= 10)
         self.bias_dropout_add_exec_handler = (
             nullcontext if use_nvfuser else torch.enable_grad
         )
 
+        # Select the bias+dropout+add functions once instead of on every forward.
+        # Module level functions and partials keep the module picklable.
+        if self.bias_dropout_fusion:
+            self._bda_train = bias_dropout_add_fused_train
+            self._bda_eval = bias_dropout_add_fused_inference
+        else:
+            self._bda_train = partial(bias_dropout_add, training=True)
+            self._bda_eval = partial(bias_dropout_add, training=False)
+        self._bda = self._bda_train if self.training else self._bda_eval
+
         if self.bias_dropout_fusion:
             set_jit_fusion_options()
             if seq_length and micro_batch_size:
@@ -1058,6 +1592,17 @@ class TransformerLayer(torch.nn.Module):
                 warmup_jit_bias_dropout_add_all_dtypes(
                     hidden_size, seq_length, micro_batch_size
                 )
+            else:
+                # The fused kernels are not specialized on the sequence and batch
+                # sizes, so a small input suffices to compile them. Sizes of 1 are
+                # avoided since the fuser treats such dimensions as broadcasts.
+                # Unlike the warmup requested by passing shapes, this one must not
+                # advance the caller's CUDA RNG or empty the allocator cache.
+                rng_state = torch.cuda.get_rng_state()
+                warmup_jit_bias_dropout_add_all_dtypes(
+                    hidden_size, 2, 2, empty_cache=False
+                )
+                torch.cuda.set_rng_state(rng_state)
 
         if self.output_layernorm:
             self.layernorm = LayerNorm(
@@ -1068,14 +1613,44 @@ class TransformerLayer(torch.nn.Module):
                 zero_centered_gamma=zero_centered_gamma
             )
 
+        # Submodules that hold a reference to the TP group.
+        self._tp_children = [self.self_attention, self.layernorm_mlp]
+        if self._is_decoder:
+            self._tp_children.append(self.inter_attention)
+
+        self.use_torch_compile = _NVTE_TORCH_COMPILE and hasattr(torch, "compile")
+
+    @staticmethod
+    def _prepare_input(hidden_states: torch.Tensor) -> torch.Tensor:
+        """Make the input contiguous and cast it for AMP, skipping both
+        when they are no-ops."""
+        if not hidden_states.is_contiguous():
+            hidden_states = hidden_states.contiguous()
+        if torch.is_autocast_enabled():
+            hidden_states = cast_if_needed(
+                hidden_states, torch.get_autocast_gpu_dtype()
+            )
+        return hidden_states
+
+    def _bias_dropout_add(
+        self, x: torch.Tensor, bias: torch.Tensor, residual: torch.Tensor
+    ) -> torch.Tensor:
+        """bias+dropout+add using the function selected for the current mode"""
+        if self.bias_dropout_add_exec_handler is nullcontext:
+            return self._bda(x, bias, residual, self.hidden_dropout)
+        with self.bias_dropout_add_exec_handler():
+            return self._bda(x, bias, residual, self.hidden_dropout)
+
+    def train(self, mode: bool = True) -> "TransformerLayer":
+        """Set training mode and select the matching bias+dropout+add function"""
+        super().train(mode)
+        self._bda = self._bda_train if mode else self._bda_eval
+        return self
+
     def set_tensor_parallel_group(self, tp_group: Union[dist_group_type, None]) -> None:
         """Set TP group"""
-        # Deep iterate but skip self to avoid infinite recursion.
-        for index, child in enumerate(self.modules()):
-            if index == 0:
-                continue
-            if hasattr(child, "set_tensor_parallel_group"):
-                child.set_tensor_parallel_group(tp_group)
+        for child in self._tp_children:
+            child.set_tensor_parallel_group(tp_group)
 
     def forward(
         self,
@@ -1122,18 +1697,37 @@ class TransformerLayer(torch.nn.Module):
                                   backprop.
         """
 
-        hidden_states = hidden_states.contiguous()
+        hidden_states = self._prepare_input(hidden_states)
 
-        if attention_mask is not None:
-            assert (
-                attention_mask.dtype == torch.bool
-            ), "Attention mask must be a boolean tensor"
-
-        # For AMP
-        if torch.is_autocast_enabled():
-            hidden_states = cast_if_needed(
-                hidden_states, torch.get_autocast_gpu_dtype()
-            )
+        forward_args = (
+            hidden_states,
+            attention_mask,
+            encoder_output,
+            enc_dec_attn_mask,
+            is_first_microbatch,
+            checkpoint_core_attention,
+            inference_params,
+        )
+        if self.use_torch_compile and not torch.onnx.is_in_onnx_export():
+            # Sequence and batch sizes vary between calls; sizes of 1 are
+            # always specialized by the compiler and cannot be marked.
+            for dim in (0, 1):
+                if hidden_states.size(dim) > 1:
+                    torch._dynamo.mark_dynamic(hidden_states, dim)
+            return _compiled(TransformerLayer._forward_impl)(self, *forward_args)
+        return self._forward_impl(*forward_args)
+
+    def _forward_impl(
+        self,
+        hidden_states: torch.Tensor,
+        attention_mask: Optional[torch.Tensor],
+        encoder_output: Optional[torch.Tensor],
+        enc_dec_attn_mask: Optional[torch.Tensor],
+        is_first_microbatch: Optional[bool],
+        checkpoint_core_attention: bool,
+        inference_params: Optional[Any],
+    ) -> torch.Tensor:
+        """TransformerLayer FWD on a prepared input"""
 
         # Self attention.
         self_attention_outputs = self.self_attention(
@@ -1149,31 +1743,20 @@ class TransformerLayer(torch.nn.Module):
             attention_output, attention_bias = self_attention_outputs
             residual = hidden_states
 
-        # Set BDA func.
-        if self.bias_dropout_fusion:
-            if self.training:
-                bias_dropout_add_func = bias_dropout_add_fused_train
-            else:
-                bias_dropout_add_func = bias_dropout_add_fused_inference
-        else:
-            bias_dropout_add_func = get_bias_dropout_add(self.training)
-
         # Bias dropoout add.
         if self.drop_path is None:
-            with self.bias_dropout_add_exec_handler():
-                bda_output = bias_dropout_add_func(
-                    attention_output, attention_bias, residual, self.hidden_dropout
-                )
+            bda_output = self._bias_dropout_add(attention_output, attention_bias, residual)
         else:
-            out = torch.nn.functional.dropout(
-                attention_output + attention_bias,
-                p=self.hidden_dropout,
-                training=self.training,
+            bda_output = self.drop_path.bias_dropout_add(
+                attention_output,
+                attention_bias,
+                residual,
+                self.hidden_dropout,
+                self.bias_dropout_fusion,
             )
-            bda_output = residual + self.drop_path(out)
 
         # Cross attention.
-        if self.layer_type == "decoder":
+        if self._is_decoder:
             inter_attention_outputs = self.inter_attention(
                 bda_output,
                 enc_dec_attn_mask,
@@ -1187,10 +1770,7 @@ class TransformerLayer(torch.nn.Module):
                 attention_output, attention_bias = inter_attention_outputs
                 residual = bda_output
 
-            with self.bias_dropout_add_exec_handler():
-                bda_output = bias_dropout_add_func(
-                    attention_output, attention_bias, residual, self.hidden_dropout
-                )
+            bda_output = self._bias_dropout_add(attention_output, attention_bias, residual)
 
         # MLP.
         mlp_outputs = self.layernorm_mlp(
@@ -1204,15 +1784,11 @@ class TransformerLayer(torch.nn.Module):
 
         # Bias dropoout add.
         if self.drop_path is None:
-            with self.bias_dropout_add_exec_handler():
-                output = bias_dropout_add_func(
-                    mlp_output, mlp_bias, residual, self.hidden_dropout
-                )
+            output = self._bias_dropout_add(mlp_output, mlp_bias, residual)
         else:
-            out = torch.nn.functional.dropout(
-                mlp_output + mlp_bias, p=self.hidden_dropout, training=self.training
+            output = self.drop_path.bias_dropout_add(
+                mlp_output, mlp_bias, residual, self.hidden_dropout, self.bias_dropout_fusion
             )
-            output = residual + self.drop_path(out)
 
         # For BERT like architectures.
         if self.output_layernorm: